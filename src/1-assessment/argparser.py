@@ -4,10 +4,7 @@ import methods
 import testimages
 
 
-def getargs():
-    if hasattr(getargs, "args"):
-        return getargs.args
-
+def _makeparser():
     parser = argparse.ArgumentParser(description="Compute and display image entropy.")
 
     opgroup = parser.add_mutually_exclusive_group()
@@ -175,7 +172,14 @@ def getargs():
         nargs="*",
     )
 
-    getargs.args = parser.parse_args()
+    return parser
+
+
+def getargs():
+    if getargs.args is not None:
+        return getargs.args
+
+    getargs.args = _parser.parse_args()
 
     if getargs.args.save_tests is None and not getargs.args.test_reshape:
         reqlst = []
@@ -184,11 +188,14 @@ def getargs():
         if len(getargs.args.files) == 0:
             reqlst.append("FILE")
         if len(reqlst) != 0:
-            parser.error(f"the following arguments are required: {', '.join(reqlst)}")
+            _parser.error(f"the following arguments are required: {', '.join(reqlst)}")
 
     return getargs.args
 
 
+getargs.args = None
+
+
 def argtypekernelsize(val):
     ival = int(val)
     if ival <= 1 or ival % 2 != 1:
@@ -215,3 +222,6 @@ def argtypepint(val):
     if ival <= 0:
         raise argparse.ArgumentTypeError(f"{ival} must be a positive integer.")
     return ival
+
+
+_parser = _makeparser()
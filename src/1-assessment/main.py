@@ -35,33 +35,38 @@ def plotall(entropy, colourimg, greyimg, plots):
         if nx > ny:
             nx, ny = ny, nx
 
+    fig = plt.gcf()
+    axes = fig.subplots(nx, ny, squeeze=False).ravel()
+    for ax in axes[nimg:]:
+        ax.axis("off")
+
     if not args.no_input_image:
-        plt.subplot(nx, ny, 1)
+        ax = axes[0]
         if colourimg.shape == greyimg.shape and np.all(colourimg == greyimg):
-            plt.imshow(colourimg, cmap=plt.cm.gray)
+            ax.imshow(colourimg, cmap=plt.cm.gray)
         else:
-            plt.imshow(colourimg)
-        plt.title("Input Image")
+            ax.imshow(colourimg)
+        ax.set_title("Input Image")
 
     if not args.no_grey_image:
-        plt.subplot(nx, ny, 2 + imgoffset)
-        plt.imshow(greyimg, cmap=plt.cm.gray)
-        plt.title("Greyscale Image")
+        ax = axes[1 + imgoffset]
+        ax.imshow(greyimg, cmap=plt.cm.gray)
+        ax.set_title("Greyscale Image")
 
     for i, plot in enumerate(plots):
         img, title, flags = plot
-        plt.subplot(nx, ny, i + 3 + imgoffset)
+        ax = axes[i + 2 + imgoffset]
         if "forcecolour" in flags:
-            plt.imshow(img, cmap=plt.cm.jet)
+            im = ax.imshow(img, cmap=plt.cm.jet)
         else:
-            plt.imshow(img, cmap=plt.cm.gray)
+            im = ax.imshow(img, cmap=plt.cm.gray)
         if "hasbar" in flags:
-            plt.colorbar()
-        plt.title(title)
+            fig.colorbar(im, ax=ax)
+        ax.set_title(title)
 
-    plt.suptitle(f"{args.method}\n$H$ = {entropy if entropy is not None else 'NaN'}")
+    fig.suptitle(f"{args.method}\n$H$ = {entropy if entropy is not None else 'NaN'}")
 
-    plt.tight_layout()
+    fig.tight_layout()
 
     return True
 
@@ -79,6 +84,10 @@ def main():
         log.warnenabled = False
         log.errenabled = False
 
+    # nothing is shown on screen, so do not load an interactive backend
+    if args.noop or args.save:
+        plt.switch_backend("agg")
+
     if not args.white_background:
         plt.style.use("dark_background")
 
@@ -100,6 +109,11 @@ def main():
         widtharrs = []
         heightarrs = []
 
+        # reshaping never grows the image, so the reference is read only once
+        if args.pi_path:
+            with open(args.pi_path, "rb") as pifl:
+                pibuf = pifl.read(args.test_width * args.test_height)
+
         for i, (testname, testfunc) in enumerate(testimages.strtofunc.items()):
             plt.figure(i + 1)
             entropies = []
@@ -114,8 +128,7 @@ def main():
             while width >= 2:
                 greyimg = testfunc(width, height)
                 colourimg = cv.cvtColor(greyimg, cv.COLOR_GRAY2RGB)
-                greyimg = greyimg.astype(np.int64)
-                colourimg = colourimg.astype(np.int64)
+                greyimg = greyimg.astype(np.int16)
 
                 entropy = methods.strtofunc[args.method](args, colourimg, greyimg)[0]
 
@@ -124,10 +137,9 @@ def main():
                 heights.append(height)
 
                 if args.pi_path:
-                    with open(args.pi_path, "rb") as pifl:
-                        buf = pifl.read(width * height)
-
-                    piarr = np.frombuffer(buf, dtype=np.uint8).reshape((height, width))
+                    piarr = np.frombuffer(
+                        pibuf, dtype=np.uint8, count=width * height
+                    ).reshape((height, width))
                     pientropy = methods.strtofunc[args.method](
                         args, cv.cvtColor(piarr, cv.COLOR_GRAY2RGB), piarr
                     )[0]
@@ -186,14 +198,16 @@ def main():
 
             assert greyimg.dtype == np.uint8, "image channel depth must be 8 bits"
 
-        # prevent over/underflows during computation
-        colourimg = colourimg.astype(np.int64)
-        greyimg = greyimg.astype(np.int64)
+        # prevent over/underflows during computation. int16 holds every difference of
+        # two 8-bit values, and the colour image is only used for plotting.
+        greyimg = greyimg.astype(np.int16)
 
         log.info("processing image")
 
-        plt.figure(i + 1)
-        hasfigure |= plotall(*methods.strtofunc[args.method](args, colourimg, greyimg))
+        results = methods.strtofunc[args.method](args, colourimg, greyimg)
+        if not args.noop:
+            plt.figure(i + 1)
+            hasfigure |= plotall(*results)
 
         log.info("benchmarking performance")
         benchmark.benchmark(
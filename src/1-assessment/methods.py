@@ -19,16 +19,30 @@
 #######################################################################################################
 
 
-from copy import deepcopy as duplicate
 from operator import itemgetter
+import functools
+import multiprocessing as mp
+import os
 
 from scipy import stats
+import cv2 as cv
 import numpy as np
 
 import log
 
+JMAX = 255  # largest absolute gradient of an 8-bit image
+
+try:
+    import numba
+
+    hasnumba = True
+except ModuleNotFoundError:
+    hasnumba = False
+
 
 def init(args):
+    global gaussian_filter, skentropy, skdisk
+
     match args.method:
         case "2d-gradient-cnn":
             from scipy.ndimage.filters import gaussian_filter
@@ -42,28 +56,40 @@ def kapur1dv(args, colourimg, greyimg):
     cdf = hist.astype(float).cumsum()  # cumulative distribution function
     binrng = np.nonzero(hist)[0][[0, -1]]
 
-    entropymax, threshold = 0, 0
-    for i in range(binrng[0], binrng[1] + 1):
-        histrng = hist[: i + 1] / cdf[i]
-        entropy = -np.sum(histrng * np.ma.log(histrng))
+    # the entropy of a class with counts $h$ and total $c$ is
+    # $\ln c - \frac{1}{c} \sum h \ln h$, so all thresholds share one cumulative sum
+    hlogh = np.zeros(hist.shape)
+    nonzero = hist > 0
+    hlogh[nonzero] = hist[nonzero] * np.log(hist[nonzero])
+    cumhlogh = hlogh.cumsum()
 
-        histrng = hist[i + 1 :]
-        histrng = histrng[np.nonzero(histrng)] / (cdf[binrng[1]] - cdf[i])
-        entropy -= np.sum(histrng * np.log(histrng))
+    thresholds = np.arange(binrng[0], binrng[1] + 1)
+    lowercdf = cdf[thresholds]
+    lowerhlogh = cumhlogh[thresholds]
+    uppercdf = cdf[-1] - lowercdf
+    upperhlogh = cumhlogh[-1] - lowerhlogh
 
-        if entropy > entropymax:
-            entropymax, threshold = entropy, i
+    entropies = np.log(lowercdf) - lowerhlogh / lowercdf
+    hasupper = uppercdf > 0
+    entropies[hasupper] += (
+        np.log(uppercdf[hasupper]) - upperhlogh[hasupper] / uppercdf[hasupper]
+    )
+
+    entropymax, threshold = 0, 0
+    best = np.argmax(entropies)
+    if entropies[best] > entropymax:
+        entropymax, threshold = entropies[best], thresholds[best]
 
     log.info(
-        f"entropy: {entropy}",
+        f"entropy: {entropymax}",
         f"threshold: {threshold}",
-        f"entropy ratio: {entropy / 8.0}",
+        f"entropy ratio: {entropymax / 8.0}",
     )
 
     entimg = np.where(greyimg < threshold, greyimg, 0)
 
     return (
-        f"{entropy} after 1 iteration",
+        f"{entropymax} after 1 iteration",
         colourimg,
         greyimg,
         [(entimg, "Kapur Threshold", ["hasbar"])],
@@ -71,7 +97,7 @@ def kapur1dv(args, colourimg, greyimg):
 
 
 def shannon1d(args, colourimg, greyimg):
-    _, counts = np.unique(greyimg.flatten(), return_counts=True)
+    _, counts = np.unique(greyimg.ravel(), return_counts=True)
     entropy = stats.entropy(counts, base=2)
 
     log.info(
@@ -82,35 +108,86 @@ def shannon1d(args, colourimg, greyimg):
     return (entropy, None, None, None)
 
 
+if hasnumba:
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _deldensityfused(flathist, total, flatdeldensity):
+        entropy = 0.0
+        for i in numba.prange(flathist.size):
+            if flathist[i]:
+                p = flathist[i] / total
+                flatdeldensity[i] = -p * np.log2(p)
+                entropy += flatdeldensity[i]
+        return entropy
+
+
+def _deldensity(hist):
+    deldensity = np.zeros(hist.shape)
+
+    # with numba, the density and its sum are computed in a single pass
+    if hasnumba:
+        entropy = _deldensityfused(hist.ravel(), hist.sum(), deldensity.ravel())
+        return deldensity, entropy
+
+    # only the non-empty bins contribute, and the histogram is mostly empty
+    flathist = hist.ravel()
+    nonzero = flathist > 0
+    density = flathist[nonzero] / flathist.sum()
+    density *= -np.log2(density)
+
+    deldensity.ravel()[nonzero] = density
+
+    return deldensity, density.sum()
+
+
+def _gradient(greyimg):
+    # same as `[f.astype(int) for f in np.gradient(greyimg)]`, but with OpenCV's
+    # vectorised filters: central differences inside, one-sided on the borders
+    img = greyimg.astype(np.float32)
+    fy = cv.Sobel(img, cv.CV_32F, 0, 1, ksize=1, scale=0.5)
+    fx = cv.Sobel(img, cv.CV_32F, 1, 0, ksize=1, scale=0.5)
+
+    fy[0, :] = img[1, :] - img[0, :]
+    fy[-1, :] = img[-1, :] - img[-2, :]
+    fx[:, 0] = img[:, 1] - img[:, 0]
+    fx[:, -1] = img[:, -1] - img[:, -2]
+
+    return fy.astype(int), fx.astype(int)
+
+
 def delentropy2d(args, colourimg, greyimg):
     ### 1609.01117 page 10
 
-    # $\nabla f(n) \approx f(n) - f(n - 1)$
-    fx = greyimg[:, 2:] - greyimg[:, :-2]
-    fy = greyimg[2:, :] - greyimg[:-2, :]
+    # $\nabla f(n) \approx f(n) - f(n - 1)$, i.e. the unsmoothed [-1, 0, 1] kernel.
+    # 8-bit images have $|J| \leq 255$, so int16 is wide enough.
+    greyimg16 = greyimg.astype(np.int16, copy=False)
+    fx = cv.Sobel(greyimg16, cv.CV_16S, 1, 0, ksize=1)
+    fy = cv.Sobel(greyimg16, cv.CV_16S, 0, 1, ksize=1)
     # fix shape
-    fx = fx[1:-1, :]
-    fy = fy[:, 1:-1]
+    fx = fx[1:-1, 1:-1]
+    fy = fy[1:-1, 1:-1]
 
     grad = fx + fy
 
     # ensure $-255 \leq J \leq 255$
-    jrng = np.max([np.max(np.abs(fx)), np.max(np.abs(fy))])
-    assert jrng <= 255, "J must be in range [-255, 255]"
+    jrng = max(fx.max(), -fx.min(), fy.max(), -fy.min())
+    assert jrng <= JMAX, "J must be in range [-255, 255]"
 
     ### 1609.01117 page 16, eq 17
 
-    hist, _, _ = np.histogram2d(
-        fx.flatten(),
-        fy.flatten(),
-        bins=256,
-    )
+    # one bin per possible gradient value, indexed by $(J_x + 255) n + (J_y + 255)$,
+    # so the histogram has the same shape for every image
+    nbins = 2 * JMAX + 1
+    binidx = fx.astype(np.int32)
+    binidx += JMAX
+    binidx *= nbins
+    binidx += fy
+    binidx += JMAX
+    hist = np.bincount(binidx.ravel(), minlength=nbins * nbins).reshape(nbins, nbins)
 
     ### 1609.01117 page 20, eq 22
 
-    deldensity = hist / np.sum(hist)
-    deldensity = deldensity * -np.ma.log2(deldensity)
-    entropy = np.sum(deldensity)
+    deldensity, entropy = _deldensity(hist)
 
     entropy /= 2  # 4.3 Papoulis generalized sampling halves the delentropy
 
@@ -124,7 +201,7 @@ def delentropy2d(args, colourimg, greyimg):
     # the previous computational steps.
     param_invert = True
 
-    gradimg = np.invert(grad) if param_invert else grad
+    gradimg = np.invert(grad, out=grad) if param_invert else grad
 
     return (
         entropy,
@@ -154,15 +231,13 @@ def delentropynd(args, colourimg, greyimg):
     ### 1609.01117 page 16
 
     hist, _ = np.histogramdd(
-        np.vstack([fx.flatten(), fy.flatten()]).transpose(),
+        np.vstack([fx.ravel(), fy.ravel()]).transpose(),
         bins=256,
     )
 
     ### 1609.01117 page 22
 
-    deldensity = hist / hist.sum()
-    deldensity = deldensity * -np.ma.log2(deldensity)
-    entropy = np.sum(deldensity)
+    deldensity, entropy = _deldensity(hist)
     entropy /= 2  # 4.3 Papoulis generalized sampling halves the delentropy
 
     log.info(
@@ -184,11 +259,9 @@ def delentropynd(args, colourimg, greyimg):
 def delentropy2dv(args, colourimg, greyimg):
     ### 1609.01117 page 10
 
-    grad = np.gradient(greyimg)
-    fx = grad[0].astype(int)
-    fy = grad[1].astype(int)
+    fx, fy = _gradient(greyimg)
 
-    grad = fx + fy
+    grad = np.add(fx, fy, dtype=np.int16)  # only used for plotting
 
     # ensure $-255 \leq J \leq 255$
     jrng = np.max([np.max(np.abs(fx)), np.max(np.abs(fy))])
@@ -197,17 +270,15 @@ def delentropy2dv(args, colourimg, greyimg):
     ### 1609.01117 page 16
 
     hist, _, _ = np.histogram2d(
-        fx.flatten(),
-        fy.flatten(),
+        fx.ravel(),
+        fy.ravel(),
         bins=256,
         range=[[-jrng, jrng], [-jrng, jrng]],
     )
 
     ### 1609.01117 page 22
 
-    deldensity = hist / np.sum(hist)
-    deldensity = deldensity * -np.ma.log2(deldensity)
-    entropy = np.sum(deldensity)
+    deldensity, entropy = _deldensity(hist)
     entropy /= 2  # 4.3 Papoulis generalized sampling halves the delentropy
 
     log.info(
@@ -220,7 +291,7 @@ def delentropy2dv(args, colourimg, greyimg):
     # the previous computational steps.
     param_invert = True
 
-    gradimg = np.invert(grad) if param_invert else grad
+    gradimg = np.invert(grad, out=grad) if param_invert else grad
 
     return (
         entropy,
@@ -253,17 +324,15 @@ def delentropy2dv2(args, colourimg, greyimg):
     ### 1609.01117 page 16
 
     hist, _, _ = np.histogram2d(
-        fx.flatten(),
-        fy.flatten(),
+        fx.ravel(),
+        fy.ravel(),
         bins=256,
         range=[[-jrng, jrng], [-jrng, jrng]],
     )
 
     ### 1609.01117 page 22
 
-    deldensity = hist / np.sum(hist)
-    deldensity = deldensity * -np.ma.log2(deldensity)
-    entropy = np.sum(deldensity)
+    deldensity, entropy = _deldensity(hist)
     entropy /= 2  # 4.3 Papoulis generalized sampling halves the delentropy
 
     log.info(
@@ -293,9 +362,7 @@ def delentropy2dv2(args, colourimg, greyimg):
 def gradient2dc(args, colourimg, greyimg):
     ### 1609.01117 page 10
 
-    grad = np.gradient(greyimg)
-    fx = grad[0].astype(int)
-    fy = grad[1].astype(int)
+    fx, fy = _gradient(greyimg)
 
     grad = fx + fy
 
@@ -306,8 +373,8 @@ def gradient2dc(args, colourimg, greyimg):
     ### 1609.01117 page 16
 
     hist, _, _ = np.histogram2d(
-        fx.flatten(),
-        fy.flatten(),
+        fx.ravel(),
+        fy.ravel(),
         bins=256,
         range=[[-jrng, jrng], [-jrng, jrng]],
     )
@@ -340,7 +407,7 @@ def gradient2dc(args, colourimg, greyimg):
 
     mu = 0.99
     roigrad = np.abs(kerngrad)
-    roigradflat = roigrad.flatten()
+    roigradflat = roigrad.ravel()
     mean = np.mean(roigrad)
     roigradbound = (
         mean,
@@ -397,8 +464,8 @@ def delentropy2dvc(args, colourimg, greyimg):
             assert jrng <= 255, "J must be in range [-255, 255]"
 
             hist, _, _ = np.histogram2d(
-                fx.flatten(),
-                fy.flatten(),
+                fx.ravel(),
+                fy.ravel(),
                 bins=256,
                 range=[[-jrng, jrng], [-jrng, jrng]],
             )
@@ -424,7 +491,7 @@ def delentropy2dvc(args, colourimg, greyimg):
 def delentropyndv(args, colourimg, greyimg):
     ### 1609.01117 page 10
 
-    grad = [f.astype(int).flatten() for f in np.gradient(greyimg)]
+    grad = [f.astype(int).ravel() for f in np.gradient(greyimg)]
 
     # ensure $-255 \leq J \leq 255$
     jrng = np.max(np.abs(grad))
@@ -439,9 +506,7 @@ def delentropyndv(args, colourimg, greyimg):
 
     ### 1609.01117 page 22
 
-    deldensity = hist / hist.sum()
-    deldensity = deldensity * -np.ma.log2(deldensity)
-    entropy = np.sum(deldensity)
+    deldensity, entropy = _deldensity(hist)
     entropy /= 2  # 4.3 Papoulis generalized sampling halves the delentropy
 
     log.info(
@@ -459,11 +524,18 @@ def delentropyndv(args, colourimg, greyimg):
     )
 
 
+@functools.lru_cache(maxsize=8)
+def _skdisk(radius):
+    return skdisk(radius)
+
+
 def scikit2dr(args, colourimg, greyimg):
     # From scikit docs:
     # The entropy is computed using base 2 logarithm i.e. the filter returns
     # the minimum number of bits needed to encode the local gray level distribution.
-    entimg = skentropy(greyimg.astype(np.uint8), skdisk(args.radius))
+    entimg = skentropy(
+        np.ascontiguousarray(greyimg, dtype=np.uint8), _skdisk(args.radius)
+    )
     entropy = entimg.mean()
 
     log.info(
@@ -479,33 +551,112 @@ def scikit2dr(args, colourimg, greyimg):
     )
 
 
-def shannon2dr(args, colourimg, greyimg):
-    entimg = duplicate(greyimg)
-    imgshape = entimg.shape
+def _shannonsat(greyimg, kernrad, levels):
+    h, w = greyimg.shape
+
+    # region bounds of each row/column, clipped to the image: [y0, y1) x [x0, x1)
+    y0 = np.clip(np.arange(h) - kernrad, 0, h)
+    y1 = np.clip(np.arange(h) + kernrad, 0, h)
+    x0 = np.clip(np.arange(w) - kernrad, 0, w)
+    x1 = np.clip(np.arange(w) + kernrad, 0, w)
+    size = np.outer(y1 - y0, x1 - x0)
+
+    # $H = \log_2 N - \frac{1}{N} \sum_v c_v \log_2 c_v$, where $c_v$ is the count
+    # of level $v$ in the region, obtained from the summed-area table of $f = v$.
+    clogc = np.zeros((h, w))
+    for v in levels:
+        sat = cv.integral((greyimg == v).astype(np.uint8))
+        counts = (
+            sat[np.ix_(y1, x1)]
+            - sat[np.ix_(y0, x1)]
+            - sat[np.ix_(y1, x0)]
+            + sat[np.ix_(y0, x0)]
+        )
+        nonzero = counts > 0
+        clogc[nonzero] += counts[nonzero] * np.log2(counts[nonzero])
+
+    return np.log2(size) - clogc / size
+
+
+def _shannonsatparallel(greyimg, kernrad, levels, cpucount):
+    h = greyimg.shape[0]
+    if cpucount is None or cpucount < 2 or h < 2 * cpucount:
+        return _shannonsat(greyimg, kernrad, levels)
+
+    # split into row bands, each padded with the rows its regions reach into. the
+    # padding either ends at the image border or covers the regions entirely, so
+    # every band clips its regions exactly like the whole image would.
+    bandheight = -(-h // cpucount)
+    bands = []
+    for i0 in range(0, h, bandheight):
+        i1 = min(h, i0 + bandheight)
+        bands.append((max(0, i0 - kernrad), i0, i1, min(h, i1 + kernrad)))
+
+    with mp.Pool(cpucount) as p:
+        results = p.starmap(
+            _shannonsat,
+            [(greyimg[top:bottom], kernrad, levels) for top, _, _, bottom in bands],
+        )
+
+    return np.vstack(
+        [res[i0 - top : i1 - top] for res, (top, i0, i1, _) in zip(results, bands)]
+    )
 
+
+if hasnumba:
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _shannonrolling(greyimg, kernrad, entimg):
+        h, w = greyimg.shape
+
+        for i in numba.prange(h):
+            y0 = max(0, i - kernrad)
+            y1 = min(h, i + kernrad)
+
+            hist = np.zeros(256, np.int32)
+            for x in range(min(w, kernrad)):
+                for y in range(y0, y1):
+                    hist[greyimg[y, x]] += 1
+
+            for j in range(w):
+                # slide the region [j - kernrad, j + kernrad) one column right
+                if j > 0:
+                    xin = j + kernrad - 1
+                    xout = j - kernrad - 1
+                    if xin < w:
+                        for y in range(y0, y1):
+                            hist[greyimg[y, xin]] += 1
+                    if xout >= 0:
+                        for y in range(y0, y1):
+                            hist[greyimg[y, xout]] -= 1
+
+                size = (y1 - y0) * (min(w, j + kernrad) - max(0, j - kernrad))
+                entropy = 0.0
+                for count in hist:
+                    if count:
+                        p = count / size
+                        entropy -= p * np.log2(p)
+                entimg[i, j] = entropy
+
+
+def shannon2dr(args, colourimg, greyimg):
     kernsize = args.kernel_size
     kernrad = round((kernsize - 1) / 2)
 
-    entropies = []
-    for i in range(imgshape[0]):
-        for j in range(imgshape[1]):
-            region = greyimg[
-                # ymax:ymin, xmax:xmin
-                np.max([0, i - kernrad]) : np.min([imgshape[0], i + kernrad]),
-                np.max([0, j - kernrad]) : np.min([imgshape[1], j + kernrad]),
-            ].flatten()
-            size = region.size
+    levels = np.unique(greyimg)
 
-            probs = [np.size(region[region == i]) / size for i in set(region)]
-            entropy = np.sum([p * np.log2(1 / p) for p in probs])
-
-            entropies.append(entropy)
-            entimg[i, j] = entropy
+    # the summed-area tables cost a pass per grey level, which is wasteful when the
+    # regions are smaller than the number of levels
+    if hasnumba and (kernsize - 1) ** 2 < len(levels):
+        entimg = np.empty(greyimg.shape)
+        _shannonrolling(greyimg.astype(np.uint8), kernrad, entimg)
+    else:
+        entimg = _shannonsatparallel(greyimg, kernrad, levels, os.cpu_count())
 
     # the average should not be used in latter computations, it's just for printing
-    entropyavg = np.average(entropies)
+    entropyavg = np.average(entimg)
     log.info(
-        f"entropy = {entropyavg} ± {np.std(entropies)}",
+        f"entropy = {entropyavg} ± {np.std(entimg)}",
     )
 
     return (
@@ -527,11 +678,11 @@ def shannon2dv1(args, colourimg, greyimg):
     fy, fx = [], []
 
     for y in range(h):
-        _, counts = np.unique(greyimg[y, :].flatten(), return_counts=True)
+        _, counts = np.unique(greyimg[y, :].ravel(), return_counts=True)
         entropy = stats.entropy(counts, base=2)
         fy.append(entropy)
     for x in range(w):
-        _, counts = np.unique(greyimg[:, x].flatten(), return_counts=True)
+        _, counts = np.unique(greyimg[:, x].ravel(), return_counts=True)
         entropy = stats.entropy(counts, base=2)
         fx.append(entropy)
 
@@ -573,11 +724,11 @@ def shannon2dv2(args, colourimg, greyimg):
     fy, fx = [], []
 
     for y in range(h):
-        _, counts = np.unique(greyimg[y, :].flatten(), return_counts=True)
+        _, counts = np.unique(greyimg[y, :].ravel(), return_counts=True)
         entropy = stats.entropy(counts, base=2)
         fy.append(entropy)
     for x in range(w):
-        _, counts = np.unique(greyimg[:, x].flatten(), return_counts=True)
+        _, counts = np.unique(greyimg[:, x].ravel(), return_counts=True)
         entropy = stats.entropy(counts, base=2)
         fx.append(entropy)
 
@@ -601,20 +752,20 @@ def shannon2dv2(args, colourimg, greyimg):
 
 
 def shannon2dv3(args, colourimg, greyimg):
-    entimg = duplicate(greyimg)
-    imgshape = entimg.shape
+    h, w = greyimg.shape
+    entimg = np.empty((h, w), dtype=np.float32)
 
     kernsize = args.kernel_size
     kernrad = round((kernsize - 1) / 2)
 
     entropies = []
-    for i in range(imgshape[0]):
-        for j in range(imgshape[1]):
+    for i in range(h):
+        for j in range(w):
             region = greyimg[
                 # ymax:ymin, xmax:xmin
-                np.max([0, i - kernrad]) : np.min([imgshape[0], i + kernrad]),
-                np.max([0, j - kernrad]) : np.min([imgshape[1], j + kernrad]),
-            ].flatten()
+                max(0, i - kernrad) : min(h, i + kernrad),
+                max(0, j - kernrad) : min(w, j + kernrad),
+            ].ravel()
             size = region.size
 
             probs = [np.size(region[region == i]) / size for i in set(region)]
@@ -623,7 +774,7 @@ def shannon2dv3(args, colourimg, greyimg):
             entropies.append(entropy)
             entimg[i, j] = entropy
 
-    hist, _ = np.histogram(entimg.flatten(), bins=args.bins_count, range=[0, 8])
+    hist, _ = np.histogram(entimg.ravel(), bins=args.bins_count, range=[0, 8])
 
     entdensity = hist / np.sum(hist)
     entdensity = entdensity * -np.ma.log2(entdensity)
@@ -679,7 +830,7 @@ def shannon2dv4(args, colourimg, greyimg):
 
 
 def shannon2d(args, colourimg, greyimg):
-    img = np.array(greyimg).flatten()
+    img = np.array(greyimg).ravel()
     hist, _, _ = np.histogram2d(img, img, bins=256)
 
     entdensity = hist / np.sum(hist)